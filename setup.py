@@ -9,4 +9,6 @@ setup(
     description='Jupyter notebook processing',
     packages=find_packages(where='src'),
     package_dir={'': 'src'},
+    python_requires='>=3.8',
+    extras_require={'fast': ['orjson']},
 )
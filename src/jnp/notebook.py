@@ -1,7 +1,58 @@
 import re
 import json
-from collections import OrderedDict
 from copy import deepcopy
+from functools import cached_property, lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@lru_cache(maxsize=32)
+def _compile(pattern):
+    """Compile pattern (str or already compiled)
+
+    Cached, so notebooks sharing a pattern share its compiled form.
+    """
+    return re.compile(pattern)
+
+
+# optional space, hash(es), at least one space, any number of non-capital
+# C (e.g. heading number such as 1.2), followed by 'Contents'
+_CONTENTS_RE = re.compile(r'\s*#+\s+[^C]*Contents')
+_ANSWER_RE = re.compile(r'\*\*A:\s*\d*\*\*')
+_CODE_ANSWER_RE = re.compile(r'#Code answer\s*\d*#')
+_CODE_TASK_RE = re.compile(r'#Code task\s*\d*#')
+_TAKES_NUMBER_RE = re.compile(r'([^<]*)(?:<n>)([^>]*)')
+# contents list bullets indexed by (sub)heading depth - 1
+_BULLETS = tuple('  ' * i + '* ' for i in range(6))
+
+
+def _bullet(hlevel):
+    if hlevel <= len(_BULLETS):
+        return _BULLETS[hlevel - 1]
+    return '  ' * (hlevel - 1) + '* '
+
+
+def _contents_lines(levels, titles, anchors):
+    """Markdown contents list bullet lines"""
+    return [f"{_bullet(level)}[{title}](#{anchor})"
+            for level, title, anchor in zip(levels, titles, anchors)]
+
+
+def _copy_cell(cell):
+    """Shallow copy of a cell with its own metadata
+
+    Raw cells become (empty output) code cells.
+    """
+    new = dict(cell)
+    if 'metadata' in new:
+        new['metadata'] = deepcopy(new['metadata'])
+    if new['cell_type'] == 'raw':
+        new.update(cell_type='code', outputs=[], execution_count=None)
+    return new
+
 
 class Notebook:
     """Class to process headings
@@ -12,38 +63,117 @@ class Notebook:
     """
     
     
-    def __init__(self, inputfile=None, regex=r'\s*(#+)([^<]*)', num_sep=".", num_start_at=1):
+    def __init__(self, inputfile=None, regex=r'\s*(#+)([^<]*)', num_sep=".", num_start_at=1,
+                 defer_outputs=False, use_orjson=False):
         self.filename = inputfile
         #num_start_at should prob be an argument to number_headings_all() as well.
         #should prob do header parameters in a heading dict as well?
-        self.regex = re.compile(regex)
+        self._regex_src = regex
         self.num_sep = num_sep
         self.head_count = [num_start_at - 1]
-        self.contents = []
+        # contents entries collected by number_headings, one list per field
+        self._toc_levels = []
+        self._toc_titles = []
+        self._toc_anchors = []
+        # rendered (or assigned) contents list, see the contents property
+        self._contents = None
+        self._contents_assigned = False
         #Do these as dicts, e.g. self.counts{'task': 0, 'question': 0}
         self.task_count = 0
         self.question_count = 0
+        # code cell outputs set aside by read(defer_outputs=True)
+        self._outputs = None
 
         if self.filename is not None:
-            self.read(self.filename)
-        
+            self.read(self.filename, defer_outputs=defer_outputs,
+                      use_orjson=use_orjson)
+
+    @cached_property
+    def regex(self):
+        """Compiled heading regex, compiled on first use"""
+        return _compile(self._regex_src)
+
+    @property
+    def contents(self):
+        """Contents list as markdown bullet lines
+
+        Rendered on first access from the headings collected by
+        number_headings, unless a list (or None) has been assigned to
+        self.contents. Either way the same list is returned each time,
+        and number_headings appends any further headings to it, so
+        in-place edits (append, insert...) are kept.
+        """
+        if self._contents is None and not self._contents_assigned:
+            self._contents = _contents_lines(
+                self._toc_levels, self._toc_titles, self._toc_anchors)
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents):
+        self._contents = contents
+        self._contents_assigned = True
 
     def copy(self):
         new = Notebook()
         new.data = deepcopy(self.data)
+        # deferred outputs are never modified, so can be shared
+        new._outputs = self._outputs
         return new
 
-    def read(self, inputfile):
+    def _with_cells(self, cells):
+        """New notebook with self.data but the given list of cells
+
+        The top level of self.data and the notebook metadata are copied;
+        the cells are used as given.
+        """
+        new = Notebook()
+        new.data = dict(self.data)
+        if 'metadata' in new.data:
+            new.data['metadata'] = deepcopy(new.data['metadata'])
+        new.data['cells'] = cells
+        new._outputs = self._outputs
+        return new
+
+    def read(self, inputfile, defer_outputs=False, use_orjson=False):
         """Read Jupyter notebook
 
         Reads notebook JSON into self.data
 
+        With use_orjson, parse with orjson (if it is installed), falling
+        back to the stdlib parser for files orjson rejects (e.g.
+        NaN/Infinity). NB orjson reads integers wider than 64 bits as
+        floats, so a read/write round trip no longer preserves them
+        exactly; only use it on notebooks known not to contain these.
+
+        With defer_outputs, each code cell's outputs (often the bulk of
+        the file, e.g. images) are moved out of self.data into a side
+        list and the cell's 'outputs' holds its index into that list.
+        This keeps copy() cheap; write() puts the outputs back.
+
         Arguments:
         inputfile - file path to notebook ipynb file
+        defer_outputs - True/False whether to set code cell outputs aside
+        use_orjson - True/False whether to parse with orjson
         """
 
-        with open(inputfile, 'r') as f:
-            self.data = json.load(f, object_pairs_hook=OrderedDict)
+        if use_orjson and orjson is not None:
+            with open(inputfile, 'rb') as f:
+                raw = f.read()
+            try:
+                self.data = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                self.data = json.loads(raw)
+        else:
+            with open(inputfile, 'r') as f:
+                self.data = json.load(f)
+        if defer_outputs:
+            self._outputs = []
+            for cell in self.data['cells']:
+                if cell['cell_type'] == 'code' and 'outputs' in cell:
+                    self._outputs.append(cell['outputs'])
+                    cell['outputs'] = len(self._outputs) - 1
+        else:
+            self._outputs = None
 
     def write(self, outputfile):
         """Write Jupyter notebook
@@ -54,9 +184,18 @@ class Notebook:
         outputfile - file path to destination notebook ipynb file
         """
 
+        data = self.data
+        if self._outputs is not None:
+            # put deferred outputs back, leaving self.data as it is
+            outputs = self._outputs
+            data = dict(data)
+            data['cells'] = [dict(cell, outputs=outputs[cell['outputs']])
+                             if isinstance(cell.get('outputs'), int) else cell
+                             for cell in data['cells']]
+        # serialise in one go rather than letting json.dump issue a
+        # write per token
         with open(outputfile, 'w') as f:
-            json.dump(self.data, f, indent=1)
-            f.write("\n") #POSIX EOF newline
+            f.write(json.dumps(data, indent=1) + "\n") #POSIX EOF newline
 
     def insert_contents(self, contents=None, overwrite=True):
         """Insert contents list
@@ -86,37 +225,38 @@ class Notebook:
 
         if contents is not None:
             self.contents = contents
-        if (self.contents is None):
+        if self.contents is None:
             return
-        else:
-            contents_found = False
-            for cell in self.data['cells']:
-                if cell['cell_type'] == 'markdown':
-                    out = []
-                    for line in cell['source']:
-                        # optional space, hash(es), at least one space,
-                        # any number of non-capital C (e.g. heading number
-                        # such as 1.2, followed by 'Contents'
-                        if re.match(r'\s*#+\s+[^C]*Contents', line):
-                            contents_found = True
-                            # keep Contents heading
-                            out.append(line)
-                            out.append('\n')
-                            # insert contents
-                            for item in self.contents:
-                                out.append(item + '\n')
-                            # insert old 'contents' if requested
-                            if not overwrite:
-                                out.append('\n')
-                                out.append(line)
-                            else:
-                                break #done with this cell
+        contents_found = False
+        contents_block = [f"{item}\n" for item in self.contents]
+        for cell in self.data['cells']:
+            if cell['cell_type'] == 'markdown':
+                out = []
+                append = out.append
+                for line in cell['source']:
+                    # cheap test before trying the regex
+                    if 'Contents' not in line:
+                        append(line)
+                        continue
+                    if _CONTENTS_RE.match(line):
+                        contents_found = True
+                        # keep Contents heading
+                        append(line)
+                        append('\n')
+                        # insert contents
+                        out.extend(contents_block)
+                        # insert old 'contents' if requested
+                        if not overwrite:
+                            append('\n')
+                            append(line)
                         else:
-                            # no Contents heading found
-                            out.append(line)
-                    cell['source'] = out
-                if contents_found:
-                    break #don't need to check any more cells
+                            break #done with this cell
+                    else:
+                        # no Contents heading found
+                        append(line)
+                cell['source'] = out
+            if contents_found:
+                break #don't need to check any more cells
 
     def number_headings_all(self):
         """Find and modify headings in all markdown cells.
@@ -124,7 +264,7 @@ class Notebook:
         """
 
         for cell in self.data['cells']:
-            if cell['cell_type'] == 'markdown':
+            if cell['cell_type'] == 'markdown' and cell['source']:
                 cell['source'] = self.number_headings(cell['source'])
 
     def number_headings(self, source):
@@ -139,34 +279,50 @@ class Notebook:
         """
         
         output = []
+        levels = []
+        titles = []
+        anchors = []
+        # bind attribute lookups used on every line/heading to locals
+        append = output.append
+        match = self.regex.match
+        head_count = self.head_count
+        num_sep = self.num_sep
         for line in source:
-            m = self.regex.match(line)
+            m = match(line)
             if m:
                 # a heading
-                hashes = m.groups()[0]
-                heading = m.groups()[1].strip()
+                hashes, heading = m.group(1, 2)
+                heading = heading.strip()
                 hlevel = len(hashes) # (sub)heading depth set by number of hashes
-                # set inc to length appropriate to (sub)heading depth
-                inc = [0] * (hlevel - 1) + [1]
-                # append 0 to head_count if subheading depth increased
-                self.head_count = [self.head_count[i] if i < len(self.head_count) else 0 for i, _ in enumerate(inc)]
-                # head_count truncates to length of inc if subheading depth decreased
-                self.head_count = [c + i for c, i in zip(self.head_count, inc)] # increment head_count at right level
-                count_str = self.num_sep.join([str(i) for i in self.head_count])
+                depth = len(head_count)
+                if depth < hlevel:
+                    # pad head_count with 0 if subheading depth increased
+                    head_count.extend([0] * (hlevel - depth))
+                elif depth > hlevel:
+                    # truncate head_count if subheading depth decreased
+                    del head_count[hlevel:]
+                head_count[hlevel - 1] += 1 # increment head_count at right level
+                count_str = num_sep.join(map(str, head_count))
                 new_heading = f"{count_str} {heading}"
                 id_str =  new_heading.replace(" ", "_")
-                id_anchr = f"<a id='{id_str}'></a>"
-                #self.contents.append(f"{hashes} [{new_heading}](#{id_str})")
-                bullet = '  ' * (len(hashes) - 1) + '* '
-                self.contents.append(f"{bullet}[{new_heading}](#{id_str})")
-                output.append(f"{hashes} {new_heading}{id_anchr}")
+                levels.append(hlevel)
+                titles.append(new_heading)
+                anchors.append(id_str)
+                # numbered heading with anchor appended
+                append(f"{hashes} {new_heading}<a id='{id_str}'></a>")
             else:
                 # not a heading
-                output.append(line)
+                append(line)
+        self._toc_levels.extend(levels)
+        self._toc_titles.extend(titles)
+        self._toc_anchors.extend(anchors)
+        if self._contents is not None:
+            # already rendered (or assigned), so add to it
+            self._contents.extend(_contents_lines(levels, titles, anchors))
         return output
         
     def _expression_takes_number(self, expression):
-        task_n_match = re.match('([^<]*)(?:<n>)([^>]*)', expression)
+        task_n_match = _TAKES_NUMBER_RE.match(expression)
         if task_n_match:
             strexp = ''.join(task_n_match.groups()) #what we'll look for in the text
             takes_number = True
@@ -179,98 +335,103 @@ class Notebook:
             task_type='code', cell_type=['raw', 'code']):
         task_id, task_takes_num = self._expression_takes_number(task)
         answer_id, answer_takes_num = self._expression_takes_number(answer)
+        # work on a local count and store it back once all cells are done
+        if task_type == 'code':
+            count = self.task_count
+        elif task_type == 'question':
+            count = self.question_count
+        else:
+            count = None
+
+        def numbered(expression):
+            if count is None:
+                return expression
+            return expression.replace(r'<n>', ' ' + str(count))
+
         for cell in self.data['cells']:
-            if cell['cell_type'] in cell_type:
+            if cell['cell_type'] in cell_type and cell['source']:
                 lines_out = []
+                append = lines_out.append
                 for line in cell['source']:
-                    line_is_task = re.match(re.escape(task_id), line)
-                    if line_is_task:
-                        if task_type == 'code':
-                            self.task_count += 1 #dict would be better
-                        elif task_type == 'question':
-                            self.question_count += 1
+                    # ids are literal text, so a prefix test is all that's needed
+                    if line.startswith(task_id):
+                        if count is not None:
+                            count += 1
                         if task_takes_num:
-                            if task_type == 'code':
-                                new_task_id = task.replace(r'<n>', ' ' + str(self.task_count))
-                            elif task_type == 'question':
-                                new_task_id = task.replace(r'<n>', ' ' + str(self.question_count))
-                            else:
-                                new_task_id = task
-                            line = line.replace(task_id, new_task_id)
-                    line_is_answer = re.match(re.escape(answer_id), line)
-                    if line_is_answer and answer_takes_num:
-                        if task_type == 'code':
-                            new_answer_id = answer.replace(r'<n>', ' ' + str(self.task_count))
-                        elif task_type == 'question':
-                            new_answer_id = answer.replace(r'<n>', ' ' + str(self.question_count))
-                        else:
-                            new_answer_id = answer
-                        line = line.replace(answer_id, new_answer_id)
-                    lines_out.append(line)
+                            # task_id is a prefix of line, so swap it directly
+                            line = numbered(task) + line[len(task_id):]
+                    if answer_takes_num and line.startswith(answer_id):
+                        line = numbered(answer) + line[len(answer_id):]
+                    append(line)
                 cell['source'] = lines_out
+        if task_type == 'code':
+            self.task_count = count
+        elif task_type == 'question':
+            self.question_count = count
         print(f'Found {self.task_count} tasks in notebook')
 
-    def student_version(self):
-        student = self.copy()
-        cells_out = []
-        for cell in student.data['cells']:
-            lines = []
+    def split_versions(self):
+        """Student and teacher notebooks from a single pass over the cells
+
+        Student notebook: answers blanked and code answers dropped.
+        Teacher notebook: code task cells dropped.
+        In both, raw cells become (empty output) code cells.
+        Each version has its own notebook and cell metadata, but cell
+        source lists and outputs are shared with this notebook (and
+        between the versions), so replace rather than modify them in
+        place.
+
+        Returns (student, teacher)
+        """
+        student_cells = []
+        teacher_cells = []
+        for cell in self.data['cells']:
+            source = cell['source']
+            firstline = source[0] if source else ''
             if cell['cell_type'] == 'markdown':
-                firstline = cell['source'][0]
+                student_cell = _copy_cell(cell)
                 #am matches an answer
-                am = re.match(r'\*\*A:\s*\d*\*\*', firstline)
+                am = firstline.startswith('**A:') and _ANSWER_RE.match(firstline)
                 if am:
-                    cell['source'] = [am.group()]
-                    cell['source'].append(' Your answer here')
-                cells_out.append(cell)
+                    student_cell['source'] = [am.group(), ' Your answer here']
+                student_cells.append(student_cell)
+                teacher_cells.append(_copy_cell(cell))
             else:
-                if cell['cell_type'] == 'raw':
-                    cell['cell_type'] = 'code'
-                    cell['outputs'] = []
-                    cell['execution_count'] = None
-                if cell['source']:
-                    firstline = cell['source'][0]
-                else:
-                    firstline = ''
-                #tm matches a task solution
-                tm = re.match(r'#Code answer\s*\d*#', firstline)
+                #am matches a task solution, tm a task to do
+                am = firstline.startswith('#Code answer') and _CODE_ANSWER_RE.match(firstline)
+                tm = firstline.startswith('#Code task') and _CODE_TASK_RE.match(firstline)
+                if not am:
+                    student_cells.append(_copy_cell(cell))
                 if not tm:
-                    cells_out.append(cell)
-        student.data['cells'] = cells_out
-        return student
+                    teacher_cells.append(_copy_cell(cell))
+        return self._with_cells(student_cells), self._with_cells(teacher_cells)
+
+    def student_version(self):
+        """Student notebook: answers blanked and code answers dropped
+
+        The returned notebook has its own metadata, but shares cell
+        source lists and outputs with this notebook.
+        See split_versions(), which builds both versions in one go.
+        """
+        return self.split_versions()[0]
 
     def teacher_version(self):
-        teacher = self.copy()
-        cells_out = []
-        for cell in teacher.data['cells']:
-            lines = []
-            if cell['cell_type'] == 'markdown':
-                cells_out.append(cell)
-            else:
-                if cell['cell_type'] == 'raw':
-                    cell['cell_type'] = 'code'
-                    cell['outputs'] = []
-                    cell['execution_count'] = None
-                if cell['source']:
-                    firstline = cell['source'][0]
-                else:
-                    firstline = ''
-                #tm matches a task to do
-                tm = re.match(r'#Code task\s*\d*#', firstline)
-                if not tm:
-                    cells_out.append(cell)
-        teacher.data['cells'] = cells_out
-        return teacher
+        """Teacher notebook: code task cells dropped
+
+        The returned notebook has its own metadata, but shares cell
+        source lists and outputs with this notebook.
+        See split_versions(), which builds both versions in one go.
+        """
+        return self.split_versions()[1]
 
     def strip_answers(self, code_task='#Code task#', code_answer='#Code answer#',
                       markdown_Q='**Q<n>:**', markdown_A='**A<n>:**'):
-        q_regexp = re.compile(re.escape(markdown_Q))
         for cell in self.data['cells']:
             cell_type = cell['cell_type']
             if cell_type == 'markdown':
                 # process according to markdown rules
                 for line in cell['source']:
-                    if q_regexp.match(line):
+                    if line.startswith(markdown_Q):
                         print(line)
                 print(f'Cell type: {cell_type} - markdown')
             elif cell_type in ['raw', 'code']: